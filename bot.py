@@ -1,132 +1,448 @@
+import atexit
+import hashlib
 import os
-import json
+import sys
 import time
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import orjson
+from types import SimpleNamespace
+import requests
+from requests.adapters import HTTPAdapter
+from binance import ThreadedWebsocketManager
 from binance.client import Client
 from binance.enums import *
-from binance.exceptions import BinanceAPIException
-from order_storage import save_or_update_orders, get_filled_orders, mark_order_filled
+from binance.exceptions import BinanceAPIException, BinanceRequestException, BinanceWebsocketUnableToConnect
+from order_storage import Session, save_or_update_orders, get_filled_orders, get_order, mark_order_filled
 
-# Настройка логгера
-logging.basicConfig(
-    filename='events.log',
-    level=logging.INFO,
-    format='[%(asctime)s] %(levelname)s: %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+class RecentLogHandler(logging.Handler):
+    """Хранит последние сообщения, чтобы они не пропадали при перерисовке экрана."""
+
+    def __init__(self, capacity=10):
+        super().__init__()
+        self.lines = deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+# Настройка логгера: запись в файл и в консоль идет в фоновом потоке, основной цикл только кладет запись в очередь
+log_queue = queue.Queue(-1)
+file_handler = logging.FileHandler('events.log')
+file_handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setFormatter(logging.Formatter('%(message)s'))
+recent_log = RecentLogHandler()
+recent_log.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', datefmt='%H:%M:%S'))
+log_listener = QueueListener(log_queue, file_handler, console_handler, recent_log)
+queue_handler = QueueHandler(log_queue)
+# Оформление записи целиком делает file_handler, в очередь уходит только текст
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Последние цены из websocket-стрима и пары, по которым нужно перечитать ордера
+latest_price = {}
+stale_symbols = set()
+# Скользящее окно цен закрытия для MA: symbol -> (closes, sum, open time последней свечи)
+_ma_state = {}
+# Последнее значение MA по паре, которое обновляет фоновый поток
+latest_ma = {}
+ma_lock = threading.Lock()
+# Ордера, ожидающие подтверждения пользователя, и готовые к отправке
+pending_confirm = queue.Queue()
+to_place = queue.Queue()
+awaiting_confirmation = None
+# Снимки состояния для потока, который рисует экран
+render_q = queue.Queue(maxsize=1)
+# Поднят, пока стрим пользовательских данных сообщает об ошибке
+user_stream_down = threading.Event()
+# Исполнение ордера может прийти и из стрима, и из сверки по REST
+fill_lock = threading.Lock()
 
 def log_info(message):
-    print(message)
     logging.info(message)
 
 def log_error(message):
-    print(message)
     logging.error(message)
 
 def get_moving_average(client, symbol, minutes=5):
-    """Вычисляет среднюю цену за N минут (по свечам)."""
-    klines = client.get_klines(symbol=symbol, interval=Client.KLINE_INTERVAL_1MINUTE, limit=minutes)
-    if not klines:
+    """Вычисляет среднюю цену за N минут (по закрытым свечам).
+
+    Окно кешируется по паре: после первого запроса догружаются только новые свечи,
+    а сумма обновляется скользящим образом.
+    """
+    state = _ma_state.get(symbol)
+    if state and state[0].maxlen == minutes:
+        closes, total, last_open = state
+        # Свечи после последней учтенной; последняя в ответе — ещё не закрытая
+        klines = client.get_klines(symbol=symbol, interval=Client.KLINE_INTERVAL_1MINUTE,
+                                   startTime=last_open + 1, limit=minutes + 1)
+        if len(klines) <= minutes:
+            for kline in klines[:-1]:
+                close = float(kline[4])  # kline[4] — цена закрытия
+                if len(closes) == closes.maxlen:
+                    total -= closes[0]
+                total += close
+                closes.append(close)
+                last_open = kline[0]
+            _ma_state[symbol] = (closes, total, last_open)
+            return total / len(closes)
+
+    # Первый запрос или окно целиком устарело — загружаем заново
+    klines = client.get_klines(symbol=symbol, interval=Client.KLINE_INTERVAL_1MINUTE, limit=minutes + 1)
+    if len(klines) < 2:
         raise ValueError(f"No Kline data for {symbol}")
-    close_prices = [float(kline[4]) for kline in klines]  # kline[4] — цена закрытия
-    return sum(close_prices) / len(close_prices)
+    closed = klines[:-1]
+    close_prices = np.fromiter((kline[4] for kline in closed), dtype=np.float64, count=len(closed))
+    closes = deque(close_prices.tolist(), maxlen=minutes)
+    total = float(close_prices.sum())
+    _ma_state[symbol] = (closes, total, klines[-2][0])
+    return total / len(closes)
+
+def refresh_moving_average(client, symbol, p):
+    with ma_lock:
+        latest_ma[symbol] = get_moving_average(client, symbol, minutes=p.ma_period)
+        return latest_ma[symbol]
+
+def start_ma_updater(client, params):
+    """Пересчитывает MA после закрытия каждой минутной свечи, чтобы не делать этого при исполнении ордера."""
+    symbols = [s for s, p in params.items() if p.use_adaptive_limit]
+    if not symbols:
+        return
+
+    def updater():
+        while True:
+            for symbol in symbols:
+                try:
+                    refresh_moving_average(client, symbol, params[symbol])
+                except Exception as e:
+                    latest_ma.pop(symbol, None)
+                    log_error(f"[ERROR] Failed to update moving average for {symbol}: {e}")
+            # Просыпаемся чуть позже начала следующей минуты, когда свеча уже закрыта
+            time.sleep(60 - time.time() % 60 + 1)
+
+    threading.Thread(target=updater, daemon=True).start()
+
+if os.name == 'nt':
+    os.system('')  # включает обработку ANSI-последовательностей в консоли Windows
 
 def clear_console():
-    os.system('cls' if os.name == 'nt' else 'clear')
+    # ANSI: курсор в начало и очистка экрана — без запуска внешней команды на каждом опросе
+    sys.stdout.write('\x1b[H\x1b[2J')
+    sys.stdout.flush()
 
 def load_settings(path='settings.json'):
-    with open(path, 'r') as f:
-        return json.load(f)
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+class FastJsonClient(Client):
+    """Client, который разбирает ответы API через orjson вместо стандартного json."""
+
+    @staticmethod
+    def _handle_response(response):
+        if not (200 <= response.status_code < 300):
+            raise BinanceAPIException(response, response.status_code, response.text)
+        if not response.content:
+            return {}
+        try:
+            return orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            raise BinanceRequestException("Invalid Response: %s" % response.text)
 
 def get_open_orders(client, symbol):
     try:
         return client.get_open_orders(symbol=symbol)
     except BinanceAPIException as e:
         log_error(f"[ERROR] Failed to fetch orders for {symbol}: {e.message}")
-        return []
+        return None
 
-def get_current_price(client, symbol):
+def get_all_prices(client):
+    """Возвращает текущие цены всех пар одним запросом: {symbol: price}."""
     try:
-        ticker = client.get_symbol_ticker(symbol=symbol)
-        return float(ticker['price'])
+        return {t['symbol']: float(t['price']) for t in client.get_all_tickers()}
     except BinanceAPIException as e:
-        log_error(f"[ERROR] Failed to fetch price for {symbol}: {e.message}")
-        return None
-
-def place_opposite_order(client, original_order, settings, symbol_config):
-    order_side = original_order.side
-    order_price = float(original_order.price)
-    symbol = original_order.symbol
+        log_error(f"[ERROR] Failed to fetch prices: {e.message}")
+        return {}
 
+def build_symbol_params(settings, symbols):
+    """Заранее разбирает настройки пар, чтобы при исполнении ордера не ходить по словарям."""
     fee = settings['global']['fee_percent'] / 100
-    profit = symbol_config['profit_percent'] / 100
     confirm = settings['global'].get('confirm_order', True)
+    params = {}
+    for symbol in symbols:
+        cfg = settings['symbols'][symbol]
+        adaptive_percent = cfg.get('adaptive_limit_percent', 0)
+        ma_period = cfg.get('moving_average_period_min', 0)
+        params[symbol] = SimpleNamespace(
+            fee=fee,
+            confirm=confirm,
+            profit=cfg['profit_percent'] / 100,
+            price_min=cfg['price_min'],
+            price_max=cfg['price_max'],
+            price_precision=cfg.get('price_precision', 2),
+            volume_sell=cfg['volume_sell'],
+            volume_buy=cfg['volume_buy'],
+            adaptive_percent=adaptive_percent,
+            adaptive_multiplier=1 + adaptive_percent / 100,
+            ma_period=ma_period,
+            use_adaptive_limit=adaptive_percent > 0 and ma_period > 0,
+        )
+    return params
 
-    price_min = symbol_config['price_min']
-    price_max = symbol_config['price_max']
-    price_precision = symbol_config.get('price_precision', 2)
+def place_opposite_order(client, original_order, p):
+    order_side = original_order.side
+    order_price = float(original_order.price)
+    symbol = original_order.symbol
+    price_precision = p.price_precision
 
     if order_side == SIDE_BUY:
-        volume = symbol_config['volume_sell']
-        price = order_price + (order_price * profit) + ((order_price * volume) * fee)
+        volume = p.volume_sell
+        price = order_price + (order_price * p.profit) + ((order_price * volume) * p.fee)
         side = SIDE_SELL
 
-        if price < price_min:
-            log_info(f"[INFO] SKIPPED: {symbol} SELL price {price:.2f} < min {price_min:.4f}")
+        if price < p.price_min:
+            log_info(f"[INFO] SKIPPED: {symbol} SELL price {price:.2f} < min {p.price_min:.4f}")
             return
 
     elif order_side == SIDE_SELL:
-        volume = symbol_config['volume_buy']
-        price = order_price - (order_price * profit) - ((order_price * volume) * fee)
+        volume = p.volume_buy
+        price = order_price - (order_price * p.profit) - ((order_price * volume) * p.fee)
         side = SIDE_BUY
 
-        if price > price_max:
-            log_info(f"[INFO] SKIPPED: {symbol} BUY price {price:.2f} > max {price_max:.4f}")
+        if price > p.price_max:
+            log_info(f"[INFO] SKIPPED: {symbol} BUY price {price:.2f} > max {p.price_max:.4f}")
             return
 
         # Проверка адаптивного коридора (если включен)
-        adaptive_percent = symbol_config.get('adaptive_limit_percent', 0)
-        ma_period = symbol_config.get('moving_average_period_min', 0)
-        if adaptive_percent > 0 and ma_period > 0:
-            try:
-                moving_avg = get_moving_average(client, symbol, minutes=ma_period)
-                adaptive_limit = moving_avg * (1 + adaptive_percent / 100)
-                if price > adaptive_limit:
-                    log_info(f"[INFO] SKIPPED: {symbol} price {price:.{price_precision}f} > adaptive limit {adaptive_limit:.{price_precision}f} (MA {moving_avg:.{price_precision}f} + {adaptive_percent}%)")
+        if p.use_adaptive_limit:
+            moving_avg = latest_ma.get(symbol)
+            if moving_avg is None:
+                # Фоновый поток ещё не посчитал MA или последнее обновление не удалось
+                try:
+                    moving_avg = refresh_moving_average(client, symbol, p)
+                except Exception as e:
+                    log_error(f"[ERROR] Failed to get moving average for {symbol}: {e}")
                     return
-            except Exception as e:
-                log_error(f"[ERROR] Failed to get moving average for {symbol}: {e}")
+            adaptive_limit = moving_avg * p.adaptive_multiplier
+            if price > adaptive_limit:
+                log_info(f"[INFO] SKIPPED: {symbol} price {price:.{price_precision}f} > adaptive limit {adaptive_limit:.{price_precision}f} (MA {moving_avg:.{price_precision}f} + {p.adaptive_percent}%)")
                 return
 
     price_str = f"{price:.{price_precision}f}"
     log_info(f"[INFO] Ready to place {side} {symbol} {volume} @ {price_str}")
 
-    if confirm:
-        user_input = input("Confirm order? [y/N]: ").strip().lower()
-        if user_input != 'y':
-            print("[INFO] Order cancelled by user.")
-            return
+    order_params = dict(
+        symbol=symbol,
+        side=side,
+        type=ORDER_TYPE_LIMIT,
+        quantity=volume,
+        price=price_str,
+        timeInForce=TIME_IN_FORCE_GTC,
+        # Детерминированный id: повтор того же ордера после таймаута биржа отклонит как дубликат
+        newClientOrderId=hashlib.blake2b(f"{original_order.order_id}-{side}-{price_str}".encode(), digest_size=10).hexdigest()
+    )
+    if p.confirm:
+        # Подтверждение ждем в отдельном потоке, чтобы не останавливать опрос
+        pending_confirm.put(order_params)
+    else:
+        to_place.put(order_params)
 
+def submit_order(client, order_params):
     try:
-        client.create_order(
-            symbol=symbol,
-            side=side,
-            type=ORDER_TYPE_LIMIT,
-            quantity=volume,
-            price=price_str,
-            timeInForce=TIME_IN_FORCE_GTC
-        )
-        log_info(f"[INFO] Order placed: {side} {symbol} {volume} @ {price_str}")
+        try:
+            client.ws_create_order(**order_params)
+        except BinanceWebsocketUnableToConnect as e:
+            log_error(f"[ERROR] WebSocket API unavailable, placing order via REST: {e}")
+            client.create_order(**order_params)
     except BinanceAPIException as e:
-        log_error(f"[ERROR] Failed to place order: {e.message}")
+        # Ордер с этим newClientOrderId уже принят — например, WebSocket API не дождался ответа
+        if e.code == -2010 and 'Duplicate' in e.message:
+            log_info(f"[INFO] Order already placed: {order_params['newClientOrderId']}")
+        else:
+            log_error(f"[ERROR] Failed to place order: {e.message}")
+        return
+    except (BinanceRequestException, requests.RequestException) as e:
+        log_error(f"[ERROR] Failed to place order: {e}")
+        return
+    log_info(f"[INFO] Order placed: {order_params['side']} {order_params['symbol']} {order_params['quantity']} @ {order_params['price']}")
+
+def start_order_worker(client, ping_interval=15):
+    """Выставляет ордера через WebSocket API.
+
+    Соединение WebSocket API привязано к event loop потока, поэтому все ордера
+    отправляются из одного потока, а остальные только кладут их в очередь.
+    Event loop работает только во время запроса, так что без ордеров поток
+    регулярно шлет ping — иначе соединение закроется и первый ордер после
+    простоя заплатит за переподключение.
+    """
+    def worker():
+        connected = True
+
+        def ping():
+            nonlocal connected
+            try:
+                client.ws_ping()
+                connected = True
+            except Exception as e:
+                # Пишем в лог только первую ошибку подряд, чтобы не засорять его без сети
+                if connected:
+                    log_error(f"[ERROR] WebSocket API ping failed: {e}")
+                connected = False
+
+        ping()  # открываем соединение заранее, до первого ордера
+        while True:
+            try:
+                order_params = to_place.get(timeout=ping_interval)
+            except queue.Empty:
+                ping()
+                continue
+            # Поток единственный, поэтому никакая ошибка не должна его завершить
+            try:
+                submit_order(client, order_params)
+            except Exception as e:
+                log_error(f"[ERROR] Failed to place order {order_params['symbol']}: {e}")
+
+    threading.Thread(target=worker, daemon=True).start()
+
+def confirmation_prompt(order_params):
+    return f"Confirm {order_params['side']} {order_params['symbol']} {order_params['quantity']} @ {order_params['price']}? [y/N]: "
+
+def start_confirmation_worker():
+    """Читает ответы пользователя и передает подтвержденные ордера в основной цикл."""
+    def worker():
+        global awaiting_confirmation
+        while True:
+            order_params = pending_confirm.get()
+            awaiting_confirmation = order_params
+            user_input = input(confirmation_prompt(order_params)).strip().lower()
+            awaiting_confirmation = None
+            if user_input == 'y':
+                to_place.put(order_params)
+            else:
+                print("[INFO] Order cancelled by user.")
+
+    threading.Thread(target=worker, daemon=True).start()
+
+def handle_filled_order(client, session, order_id, p):
+    """Выставляет обратный ордер для исполненного, если он ещё не обработан."""
+    with fill_lock:
+        order = get_order(session, order_id)
+        if not order or order.status != 'OPEN':
+            return
+        log_info(f"[INFO] Order executed: {order.side} {order.symbol} {order.volume} @ {order.price}")
+        place_opposite_order(client, order, p)
+        mark_order_filled(session, order.order_id)
+        # Коммитим под блокировкой, чтобы другой поток увидел, что ордер уже обработан
+        session.commit()
+
+def setup_http_session(client):
+    """Пул keep-alive соединений, чтобы запросы не платили за новый TLS-хендшейк."""
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=3)
+    client.session.mount('https://', adapter)
+    client.session.headers['Connection'] = 'keep-alive'
+
+def start_keepalive(client, interval=60):
+    """Периодический ping держит соединение с API прогретым между опросами."""
+    def ping_loop():
+        while True:
+            time.sleep(interval)
+            try:
+                client.ping()
+            except Exception as e:
+                log_error(f"[ERROR] Ping failed: {e}")
+
+    threading.Thread(target=ping_loop, daemon=True).start()
+
+def start_renderer():
+    """Выводит состояние на экран в отдельном потоке, чтобы медленный терминал не тормозил опрос."""
+    def renderer():
+        while True:
+            snapshot = render_q.get()
+            clear_console()
+            for row in snapshot['symbols']:
+                # Цены может не быть, если ни стрим, ни REST ещё не ответили
+                price_str = f"{row['price']:.4f}" if row['price'] is not None else "n/a"
+                print(f"[INFO] {row['symbol']} | Price: {price_str} | Open orders: {len(row['orders'])} | Profit: {row['profit']} | {snapshot['time']}")
+                precision = row['volume_precision']
+                for order in row['orders']:
+                    qty = float(order['origQty'])
+                    price = float(order['price'])
+                    print(f" - {order['symbol']} {order['side']} {qty:.{precision}f} @ {price:.4f}")
+                print()
+            # Последние события — иначе очистка экрана стерла бы их сразу после вывода
+            for line in list(recent_log.lines):
+                print(line)
+            # Экран перерисован — напоминаем о вопросе, на который ждем ответа
+            if snapshot['prompt']:
+                print(confirmation_prompt(snapshot['prompt']), end='', flush=True)
+
+    threading.Thread(target=renderer, daemon=True).start()
+
+def start_streams(client, settings, params):
+    """Подписывается на цены и события ордеров, чтобы не ждать очередного опроса REST."""
+
+    def on_book_ticker(msg):
+        if 's' not in msg:
+            log_error(f"[ERROR] Price stream error: {msg}")
+            return
+        latest_price[msg['s']] = (float(msg['b']) + float(msg['a'])) / 2
+
+    def on_user_event(msg):
+        if msg.get('e') == 'error':
+            # Стрим упал — пока он не восстановится, ищем исполнения по REST на каждом опросе
+            log_error(f"[ERROR] User data stream error: {msg}")
+            user_stream_down.set()
+            stale_symbols.update(params)
+            return
+        # Любое другое сообщение означает, что стрим снова работает
+        user_stream_down.clear()
+        if msg.get('e') != 'executionReport' or msg['s'] not in params:
+            return
+        stale_symbols.add(msg['s'])
+        # Бот выставляет только лимитные ордера; у рыночных в 'p' ноль,
+        # и обратный ордер по такой цене выставлять нельзя
+        if msg['X'] != ORDER_STATUS_FILLED or msg['o'] != ORDER_TYPE_LIMIT:
+            return
+        try:
+            with Session() as session:
+                if not get_order(session, msg['i']):
+                    # Ордер успел исполниться до того, как попал в базу
+                    save_or_update_orders(session, [{
+                        'orderId': msg['i'],
+                        'symbol': msg['s'],
+                        'side': msg['S'],
+                        'price': msg['p'],
+                        'origQty': msg['q'],
+                    }])
+                    session.commit()
+                handle_filled_order(client, session, msg['i'], params[msg['s']])
+        except Exception as e:
+            log_error(f"[ERROR] Failed to handle fill for {msg['s']}: {e}")
+
+    twm = ThreadedWebsocketManager(api_key=settings['global']['api_key'], api_secret=settings['global']['api_sec'])
+    twm.start()
+    for symbol in params:
+        twm.start_symbol_book_ticker_socket(callback=on_book_ticker, symbol=symbol)
+    # listenKey и его продление python-binance обслуживает сам
+    twm.start_user_socket(callback=on_user_event)
+    return twm
 
 def main():
     settings = load_settings()
     api_key = settings['global']['api_key']
     api_sec = settings['global']['api_sec']
     poll_interval = settings['global'].get('poll_interval_sec', 10)
+    reconcile_interval = settings['global'].get('reconcile_interval_sec', 300)
 
-    client = Client(api_key, api_sec)
+    client = FastJsonClient(api_key, api_sec)
+    setup_http_session(client)
+    start_keepalive(client)
 
     symbols_config = settings['symbols']
     active_symbols = [s for s, cfg in symbols_config.items() if cfg.get('is_active')]
@@ -134,37 +450,97 @@ def main():
         print("[INFO] No active symbols found.")
         return
 
+    params = build_symbol_params(settings, active_symbols)
+    twm = start_streams(client, settings, params)
+    open_orders_by_symbol = {}
+    # id открытых ордеров по паре из прошлого снимка REST
+    prev_open_ids = {}
+    last_reconcile = 0
+    executor = ThreadPoolExecutor(max_workers=16)
+    start_order_worker(client)
+    start_ma_updater(client, params)
+    start_renderer()
+    if settings['global'].get('confirm_order', True):
+        start_confirmation_worker()
+
     try:
         while True:
-            clear_console()
-            for symbol in active_symbols:
-                cfg = symbols_config[symbol]
-                current_price = get_current_price(client, symbol)
-                open_orders = get_open_orders(client, symbol)
-                save_or_update_orders(open_orders)
-                existing_orders = get_filled_orders([symbol])
-                open_order_ids = {o['orderId'] for o in open_orders}
-
-                for order in existing_orders:
-                    if order.order_id not in open_order_ids:
-                        log_info(f"[INFO] Order executed: {order.side} {symbol} {order.volume} @ {order.price}")
-                        place_opposite_order(client, order, settings, cfg)
-                        mark_order_filled(order.order_id)
-
-                t = time.localtime()
-                current_time = time.strftime("%H:%M:%S", t)
-                print(f"[INFO] {symbol} | Price: {current_price:.4f} | Open orders: {len(open_orders)} | Profit: {cfg['profit_percent']} | {current_time}")
-                for order in open_orders:
-                    qty = float(order['origQty'])
-                    price = float(order['price'])
-                    precision = cfg.get('volume_precision', 1)
-                    print(f" - {order['symbol']} {order['side']} {qty:.{precision}f} @ {price:.4f}")
-                print()
+            poll_started = time.monotonic()
+            # Полная сверка по REST — страховка на случай пропущенных событий стрима
+            reconcile = time.time() - last_reconcile >= reconcile_interval
+            if reconcile:
+                last_reconcile = time.time()
+            if all(s in latest_price for s in active_symbols):
+                prices = latest_price
+            else:
+                prices = get_all_prices(client)
+
+            # Открытые ордера по всем парам запрашиваем параллельно, а обрабатываем последовательно
+            to_refresh = [s for s in active_symbols
+                          if reconcile or user_stream_down.is_set() or s in stale_symbols
+                          or s not in open_orders_by_symbol]
+            stale_symbols.difference_update(to_refresh)
+            fetched = dict(zip(to_refresh, executor.map(lambda s: get_open_orders(client, s), to_refresh)))
+            # Ошибка запроса — не пустой снимок: иначе все ордера пары сочтем исполненными.
+            # Оставляем прошлый снимок и пробуем снова на следующем опросе
+            for symbol in [s for s, orders in fetched.items() if orders is None]:
+                del fetched[symbol]
+                stale_symbols.add(symbol)
+
+            current_time = time.strftime("%H:%M:%S", time.localtime())
+            # Одна сессия на весь опрос вместо отдельной на каждый вызов
+            with Session() as session:
+                # Открытые ордера из базы читаем только при сверке и первом опросе пары
+                # (одним запросом на все такие пары), в остальное время хватает разницы
+                # с прошлым снимком
+                full_check = [s for s in fetched if reconcile or s not in prev_open_ids]
+                existing_by_symbol = defaultdict(set)
+                if full_check:
+                    for order in get_filled_orders(session, full_check):
+                        existing_by_symbol[order.symbol].add(order.order_id)
+
+                rows = []
+                for symbol in active_symbols:
+                    cfg = symbols_config[symbol]
+                    if symbol in fetched:
+                        open_orders = fetched[symbol]
+                        open_orders_by_symbol[symbol] = open_orders
+                        open_order_ids = {o['orderId'] for o in open_orders}
+                        prev_ids = prev_open_ids.get(symbol, set())
+                        prev_open_ids[symbol] = open_order_ids
+
+                        new_ids = open_order_ids - prev_ids
+                        save_or_update_orders(session, [o for o in open_orders if o['orderId'] in new_ids])
+                        # Коммитим вставку до fill_lock: поток стрима берет сначала fill_lock,
+                        # потом блокировку записи SQLite — порядок должен быть тем же
+                        session.commit()
+                        gone_ids = (prev_ids | existing_by_symbol[symbol]) - open_order_ids
+                        for order_id in gone_ids:
+                            handle_filled_order(client, session, order_id, params[symbol])
+                        session.commit()
+                    rows.append({
+                        'symbol': symbol,
+                        'price': prices.get(symbol),
+                        'profit': cfg['profit_percent'],
+                        'volume_precision': cfg.get('volume_precision', 1),
+                        'orders': open_orders_by_symbol.get(symbol, []),
+                    })
+
+            # Экран рисует отдельный поток; если он не успевает, выбрасываем устаревший кадр
+            try:
+                render_q.get_nowait()
+            except queue.Empty:
+                pass
+            render_q.put_nowait({'time': current_time, 'symbols': rows, 'prompt': awaiting_confirmation})
 
-            time.sleep(poll_interval)
+            # Вычитаем время самого опроса, чтобы период не уплывал
+            time.sleep(max(0, poll_interval - (time.monotonic() - poll_started)))
 
     except KeyboardInterrupt:
         print("\n[INFO] Interrupted by user.")
+    finally:
+        executor.shutdown(wait=False)
+        twm.stop()
 
 if __name__ == "__main__":
     main()
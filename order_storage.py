@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, BigInteger
+from sqlalchemy import create_engine, event, Column, Integer, String, Float, BigInteger, Index
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import declarative_base, sessionmaker
 import time
 
@@ -14,36 +15,52 @@ class Order(Base):
     status = Column(String)
     created_at = Column(BigInteger)
 
+    __table_args__ = (Index('ix_orders_status_symbol', 'status', 'symbol'),)
+
 engine = create_engine('sqlite:///orders.db')
+
+@event.listens_for(engine, 'connect')
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
 Base.metadata.create_all(engine)
+# create_all не добавляет индексы в уже существующую таблицу
+for index in Order.__table__.indexes:
+    index.create(engine, checkfirst=True)
 Session = sessionmaker(bind=engine)
 
-def save_or_update_orders(order_list):
-    with Session() as session:
-        for o in order_list:
-            order = session.query(Order).filter_by(order_id=o['orderId']).first()
-            if order:
-                order.status = 'OPEN'
-            else:
-                order = Order(
-                    order_id=o['orderId'],
-                    symbol=o['symbol'],
-                    side=o['side'],
-                    price=float(o['price']),
-                    volume=float(o['origQty']),
-                    status='OPEN',
-                    created_at=int(time.time())
-                )
-                session.add(order)
-        session.commit()
-
-def get_filled_orders(active_symbols):
-    with Session() as session:
-        return session.query(Order).filter(Order.status == 'OPEN', Order.symbol.in_(active_symbols)).all()
-
-def mark_order_filled(order_id):
-    with Session() as session:
-        order = session.query(Order).filter_by(order_id=order_id).first()
-        if order:
-            order.status = 'FILLED'
-            session.commit()
+# Функции ниже работают в переданной сессии и не коммитят — транзакцией управляет вызывающий код
+
+def save_or_update_orders(session, order_list):
+    if not order_list:
+        return
+    now = int(time.time())
+    rows = [{
+        'order_id': o['orderId'],
+        'symbol': o['symbol'],
+        'side': o['side'],
+        'price': float(o['price']),
+        'volume': float(o['origQty']),
+        'status': 'OPEN',
+        'created_at': now,
+    } for o in order_list]
+    # Уже известный ордер не трогаем: его исполнение могло прийти из стрима
+    # раньше, чем он пропал из снимка открытых ордеров
+    stmt = sqlite_insert(Order).values(rows).on_conflict_do_nothing(index_elements=['order_id'])
+    session.execute(stmt)
+
+def get_filled_orders(session, active_symbols):
+    return session.query(Order).filter(Order.status == 'OPEN', Order.symbol.in_(active_symbols)).all()
+
+def get_order(session, order_id):
+    # populate_existing — статус мог поменяться в другой сессии (поток стрима)
+    return session.query(Order).populate_existing().filter_by(order_id=order_id).first()
+
+def mark_order_filled(session, order_id):
+    order = session.query(Order).filter_by(order_id=order_id).first()
+    if order:
+        order.status = 'FILLED'